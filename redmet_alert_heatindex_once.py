@@ -1,9 +1,38 @@
+import hashlib
+import hmac
+import json
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional: faster JSON encode/decode
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+
+# One pooled session for every call: keep-alive + connection reuse.
+# Retry only covers idempotent methods (GET), so Telegram POSTs are never resent,
+# and never read timeouts, so a hung REDMET costs one timeout, not four.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    ),
+)
 
 
 # ----------------------------
@@ -13,7 +42,19 @@ def env(name: str, default: str = "") -> str:
     return os.getenv(name, default).strip()
 
 
-def safe_float(x):
+def json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def json_loads(b: bytes):
+    if orjson is not None:
+        return orjson.loads(b)
+    return json.loads(b)
+
+
+def safe_float(x) -> float | None:
     if x is None:
         return None
     try:
@@ -22,8 +63,13 @@ def safe_float(x):
         return None
 
 
-def parse_api_dt(s: str):
+@lru_cache(maxsize=4096)
+def parse_api_dt(s: str) -> datetime | None:
+    # Fast path for the fixed "YYYY-MM-DD HH:MM:SS" layout REDMET returns;
+    # strptime only for anything that doesn't match it exactly.
     try:
+        if len(s) == 19 and s[4] == "-" and s[7] == "-" and s[10] == " " and s[13] == ":" and s[16] == ":":
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
         return datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
     except Exception:
         return None
@@ -34,46 +80,196 @@ def floor_to_slot(dt: datetime, slot_minutes: int) -> datetime:
     return dt.replace(minute=m, second=0, microsecond=0)
 
 
-def build_slots(now_local: datetime, slot_minutes: int, max_age_min: int):
+def build_slots(now_local: datetime, slot_minutes: int, max_age_min: int) -> tuple[list[datetime], datetime]:
     base_slot = floor_to_slot(now_local, slot_minutes)
-    slots = []
-    mins = 0
-    while mins <= max_age_min:
-        slots.append(base_slot - timedelta(minutes=mins))
-        mins += slot_minutes
+    slots = [base_slot - timedelta(minutes=m) for m in range(0, max_age_min + 1, slot_minutes)]
     return slots, base_slot
 
 
-def send_telegram_html(token: str, chat_ids: list[str], message_html: str):
+def seconds_to_next_slot(now_local: datetime, slot_minutes: int) -> float:
+    next_slot = floor_to_slot(now_local, slot_minutes) + timedelta(minutes=slot_minutes)
+    return (next_slot - now_local).total_seconds()
+
+
+def send_telegram_html(token: str, chat_ids: list[str], message_html: str) -> None:
+    if not chat_ids:
+        return
+
     url = f"https://api.telegram.org/bot{token}/sendMessage"
-    for cid in chat_ids:
-        payload = {
-            "chat_id": cid,
-            "text": message_html,
-            "parse_mode": "HTML",
-            "disable_web_page_preview": True,
-        }
-        r = requests.post(url, json=payload, timeout=20)
+    base = {
+        "text": message_html,
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True,
+    }
+
+    def send_one(cid: str) -> None:
+        r = SESSION.post(
+            url,
+            data=json_dumps({**base, "chat_id": cid}),
+            headers={"Content-Type": "application/json"},
+            timeout=20,
+        )
         r.raise_for_status()
 
+    with ThreadPoolExecutor(max_workers=min(8, len(chat_ids))) as ex:
+        list(ex.map(send_one, chat_ids))
+
+
+# ----------------------------
+# On-disk state (response cache, last alert)
+# ----------------------------
+def read_json(path: Path) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def write_json_atomic(path: Path, data: dict) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"WARN: Could not write {path}: {e}", file=sys.stderr)
+
+
+CACHE_KEEP_SECONDS = 24 * 3600  # stale entries kept this long for fallback
+
+_cache_lock = threading.Lock()
+_cache = None
+
+# How REDMET calls were answered this run: "live" (network or unexpired
+# entry) vs "stale" (request failed, expired entry served instead)
+_fetch_stats = {"live": 0, "stale": 0}
+
+
+def _count_fetch(kind: str) -> None:
+    with _cache_lock:
+        _fetch_stats[kind] += 1
+
+
+def redmet_unreachable() -> bool:
+    # Every call fell back to an expired entry: REDMET is down or rejecting us
+    with _cache_lock:
+        return _fetch_stats["stale"] > 0 and _fetch_stats["live"] == 0
+
+
+def cache_path() -> Path:
+    return Path(env("REDMET_CACHE_FILE") or str(Path.home() / ".cache" / "redmet.json"))
+
+
+def _load_cache() -> dict:
+    global _cache
+    if _cache is None:
+        _cache = read_json(cache_path())
+    return _cache
+
+
+def cache_get(key: str) -> dict | None:
+    with _cache_lock:
+        return _load_cache().get(key)
+
+
+def cache_id(secret: str, text: str) -> str:
+    # Keys and URLs carry LAT/LON and the cache file is shipped to the Actions
+    # cache, so only store a keyed hash of them (plain SHA-256 of a coordinate
+    # pair would be cheap to brute-force)
+    return hmac.new(secret.encode("utf-8"), text.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def cache_put(key: str, body, ttl: float, url_hash: str = "", etag: str = "", last_modified: str = "") -> None:
+    now = time.time()
+    with _cache_lock:
+        cache = _load_cache()
+        cache[key] = {
+            "ts": now,
+            "expires": now + ttl,
+            "url_hash": url_hash,
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body,
+        }
+        for k in [k for k, v in cache.items() if now - v.get("ts", 0) > CACHE_KEEP_SECONDS]:
+            del cache[k]
+
+        write_json_atomic(cache_path(), cache)
+
 
 # ----------------------------
 # REDMET calls
 # ----------------------------
-def get_nearest_stations(base_ws: str, lat: str, lon: str, user: str, password: str):
+def redmet_get_json(url: str, params, user: str, password: str, timeout: int, cache_key: str, ttl: float,
+                    revalidate: bool = True):
+    cache_key = cache_id(password, cache_key)
+    entry = cache_get(cache_key)
+    if entry and time.time() < entry.get("expires", 0):
+        _count_fetch("live")
+        return entry.get("body")
+
+    # Revalidate an expired entry instead of re-downloading it. Validators
+    # belong to one exact URL + query, so only send them for that same
+    # request. Callers whose URL changes between runs pass revalidate=False.
+    full_url = requests.Request("GET", url, params=params).prepare().url or url
+    url_hash = cache_id(password, full_url) if revalidate else ""
+    headers = {"Accept": "application/json"}
+    if revalidate and entry and entry.get("url_hash") == url_hash:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    revalidating = len(headers) > 1
+
+    try:
+        r = SESSION.get(
+            url,
+            params=params,
+            headers=headers,
+            auth=HTTPBasicAuth(user, password),
+            timeout=timeout,
+        )
+        if r.status_code == 304 and revalidating and entry is not None:
+            data = entry.get("body")
+            if ttl > 0:
+                etag = r.headers.get("ETag") or entry.get("etag", "")
+                last_modified = r.headers.get("Last-Modified") or entry.get("last_modified", "")
+                cache_put(cache_key, data, ttl, url_hash, etag, last_modified)
+            _count_fetch("live")
+            return data
+
+        r.raise_for_status()
+        data = json_loads(r.content)
+    except (requests.RequestException, ValueError) as e:
+        if entry is None:
+            raise
+        print(f"WARN: REDMET request failed ({e}); using cached response.", file=sys.stderr)
+        _count_fetch("stale")
+        return entry.get("body")
+
+    _count_fetch("live")
+    if ttl > 0:
+        if revalidate:
+            cache_put(cache_key, data, ttl, url_hash, r.headers.get("ETag", ""), r.headers.get("Last-Modified", ""))
+        else:
+            cache_put(cache_key, data, ttl)
+    return data
+
+
+def get_nearest_stations(base_ws: str, lat: str, lon: str, user: str, password: str,
+                         ttl: float = 60) -> list[dict]:
     url = f"{base_ws.rstrip('/')}/getLecturas/{lat}/{lon}"
-    r = requests.get(
-        url,
-        headers={"Accept": "application/json"},
-        auth=HTTPBasicAuth(user, password),
-        timeout=30,
-    )
-    r.raise_for_status()
-    data = r.json()
+    data = redmet_get_json(url, None, user, password, 30, f"redmet:getLecturas:{lat}:{lon}", ttl)
+    if not isinstance(data, dict):
+        return []
     return data.get("estaciones", []) or []
 
 
-def get_station_records(base_ws: str, estacionid: str, fechaini: str, fechafin: str, user: str, password: str):
+def get_station_records(base_ws: str, estacionid: str, fechaini: str, fechafin: str, user: str, password: str,
+                        ttl: float = 0) -> list[dict]:
     url = f"{base_ws.rstrip('/')}/redmet/estaciones/lecturas"
     params = {
         "fechaini": fechaini,
@@ -81,15 +277,14 @@ def get_station_records(base_ws: str, estacionid: str, fechaini: str, fechafin:
         "tipo": "fecha",
         "estacionids[]": estacionid,
     }
-    r = requests.get(
-        url,
-        params=params,
-        headers={"Accept": "application/json"},
-        auth=HTTPBasicAuth(user, password),
-        timeout=60,
-    )
-    r.raise_for_status()
-    data = r.json()
+    # Key on the window length, not its endpoints, so runs within one slot share it
+    ini_dt = parse_api_dt(f"{fechaini}:00")
+    fin_dt = parse_api_dt(f"{fechafin}:00")
+    span = int((fin_dt - ini_dt).total_seconds() // 60) if ini_dt and fin_dt else f"{fechaini}-{fechafin}"
+    cache_key = f"redmet:lecturas:{estacionid}:{span}"
+    # No conditional GET here: fechaini/fechafin move every minute, so by the
+    # time an entry expires (next slot) the URL no longer matches its validators
+    data = redmet_get_json(url, params, user, password, 60, cache_key, ttl, revalidate=False)
 
     if isinstance(data, dict):
         return data.get(str(estacionid), []) or []
@@ -100,38 +295,104 @@ def get_station_records(base_ws: str, estacionid: str, fechaini: str, fechafin:
     return []
 
 
-def pick_heatindex_record(records: list[dict], slots: list[datetime], slot_minutes: int):
-    by_slot = {}
+def _fecha_key(rec: dict) -> str:
+    fecha = rec.get("fecha")
+    return fecha if isinstance(fecha, str) else ""
+
+
+def get_combined(endpoint: str, lat: str, lon: str, user: str, password: str,
+                 ttl: float = 0) -> tuple[list[dict], dict]:
+    # Optional aggregation shim: {"estaciones": [...], "lecturas": {estacionid: [...]}}
+    params = {"lat": lat, "lon": lon}
+    data = redmet_get_json(endpoint, params, user, password, 60, f"combined:{lat}:{lon}", ttl)
+    estaciones = data.get("estaciones") if isinstance(data, dict) else None
+    if not estaciones or not isinstance(estaciones, list):
+        # Let main fall back to REDMET rather than report "no stations"
+        raise ValueError("combined response has no estaciones")
+
+    lecturas = data.get("lecturas")
+    return estaciones, lecturas if isinstance(lecturas, dict) else {}
+
+
+HeatIndexPick = tuple[dict | None, float | None, float | None, datetime | None, datetime | None]
 
-    for rec in records:
+
+def pick_heatindex_record(records: list[dict], slots: list[datetime], slot_minutes: int) -> HeatIndexPick:
+    if not slots:
+        return None, None, None, None, None
+
+    # Slots keyed by (y, m, d, h, floored minute): same bucket as floor_to_slot()
+    # without allocating a datetime per record
+    slot_by_key = {(s.year, s.month, s.day, s.hour, s.minute): s for s in slots}
+    cutoff = min(slots).strftime("%Y-%m-%d %H:%M:%S")
+
+    # Newest first ("%Y-%m-%d %H:%M:%S" sorts chronologically), so the
+    # first record that lands in a wanted slot is the answer, and once
+    # fecha drops below the oldest slot nothing further can match.
+    for rec in sorted(records, key=_fecha_key, reverse=True):
         fecha = rec.get("fecha")
         if not isinstance(fecha, str):
             continue
+        if fecha < cutoff:
+            break
 
         dt = parse_api_dt(fecha)
         if not dt:
             continue
 
-        rec_slot = floor_to_slot(dt, slot_minutes)
+        rec_slot = slot_by_key.get((dt.year, dt.month, dt.day, dt.hour, (dt.minute // slot_minutes) * slot_minutes))
+        if rec_slot is None:
+            continue
+
         hi_val = safe_float(rec.get("indice_calor"))
         if hi_val is None:
             continue
 
         t_val = safe_float(rec.get("temperatura"))  # info only
-        by_slot[rec_slot] = (rec, hi_val, t_val, dt)
-
-    for slot in slots:
-        if slot in by_slot:
-            rec, hi_val, t_val, dt_api = by_slot[slot]
-            return rec, hi_val, t_val, dt_api, slot
+        return rec, hi_val, t_val, dt, rec_slot
 
     return None, None, None, None, None
 
 
+def pick_from_stations(base_ws: str, candidates: list[dict], fechaini: str, fechafin: str, user: str,
+                       password: str, ttl: float, slots: list[datetime], slot_minutes: int) -> tuple | None:
+    # Fetch all candidates in parallel, then pick in priority order.
+    # No `with` block: its shutdown(wait=True) would delay the return (and
+    # so the alert) until the slowest lower-priority fetch finishes. Fetches
+    # already running are not interrupted, and concurrent.futures still joins
+    # them at interpreter exit, so the process can outlive the alert by up to
+    # one request timeout.
+    ex = ThreadPoolExecutor(max_workers=max(1, len(candidates)))
+    try:
+        futs = [
+            ex.submit(get_station_records, base_ws, str(sta["estacionid"]), fechaini, fechafin, user, password, ttl)
+            for sta in candidates
+        ]
+
+        for sta, fut in zip(candidates, futs):
+            rec, hi_val, t_val, dt_api, slot_used = pick_heatindex_record(fut.result(), slots, slot_minutes)
+            if rec is not None:
+                return sta, rec, hi_val, t_val, dt_api, slot_used
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    return None
+
+
 # ----------------------------
 # Main (single run)
 # ----------------------------
-def main():
+def exit_without_alert(message: str) -> int:
+    # A stale-cache-only run must not look like a healthy "nothing to report"
+    if redmet_unreachable():
+        print(f"ERROR: REDMET unreachable, only expired cached responses were available. {message}",
+              file=sys.stderr)
+        return 1
+    print(f"INFO: {message}")
+    return 0
+
+
+def main() -> int:
     telegram_token = env("TELEGRAM_TOKEN")
     chat_id_raw = env("CHAT_ID")
 
@@ -147,49 +408,100 @@ def main():
     chat_ids = [c.strip() for c in chat_id_raw.split(",") if c.strip()]
 
     base_ws = env("REDMET_BASE", "https://redmet.icc.org.gt/ws")
-    heat_index_threshold = float(env("HEAT_INDEX_THRESHOLD", "10"))
+    try:
+        heat_index_threshold = float(env("HEAT_INDEX_THRESHOLD") or "10")
+        slot_minutes = int(env("SLOT_MINUTES") or "15")
+        max_age_min = int(env("MAX_AGE_MIN") or "45")
+        lookback_hours = int(env("LOOKBACK_HOURS") or "6")
+        suppress_if_older_than_min = int(env("SUPPRESS_IF_OLDER_THAN_MIN") or "90")
+    except ValueError as e:
+        print(f"ERROR: Invalid numeric setting: {e}", file=sys.stderr)
+        return 2
 
-    slot_minutes = int(env("SLOT_MINUTES") or "15")
-    max_age_min = int(env("MAX_AGE_MIN") or "45")
-    lookback_hours = int(env("LOOKBACK_HOURS") or "6")
-    suppress_if_older_than_min = int(env("SUPPRESS_IF_OLDER_THAN_MIN") or "90")
+    if slot_minutes <= 0 or max_age_min < 0 or suppress_if_older_than_min < 0:
+        print("ERROR: SLOT_MINUTES must be > 0; MAX_AGE_MIN and SUPPRESS_IF_OLDER_THAN_MIN >= 0.", file=sys.stderr)
+        return 2
+
+    # LOOKBACK_HOURS caps the query window; it must still cover every slot
+    if lookback_hours * 60 < max_age_min + slot_minutes * 2:
+        print(
+            f"ERROR: LOOKBACK_HOURS must cover MAX_AGE_MIN + 2*SLOT_MINUTES ({max_age_min + slot_minutes * 2} min).",
+            file=sys.stderr,
+        )
+        return 2
 
     now_local = datetime.now()
-    slots, _ = build_slots(now_local, slot_minutes, max_age_min)
+    slots, base_slot = build_slots(now_local, slot_minutes, max_age_min)
+
+    # Don't hit REDMET at all if this slot already produced an alert
+    state_path = Path(env("STATE_FILE") or "/tmp/alarma_state.json")
+    state = read_json(state_path)
+    if state.get("last_alerted_slot") == base_slot.isoformat():
+        print("INFO: Already alerted this slot.")
+        return 0
 
-    fechaini = (now_local - timedelta(hours=lookback_hours)).strftime("%Y-%m-%d %H:%M")
+    # Ask only for the slots we can use; LOOKBACK_HOURS only caps the window
+    fechaini = max(
+        now_local - timedelta(minutes=max_age_min + slot_minutes * 2),
+        now_local - timedelta(hours=lookback_hours),
+    ).strftime("%Y-%m-%d %H:%M")
     fechafin = now_local.strftime("%Y-%m-%d %H:%M")
+    records_ttl = seconds_to_next_slot(now_local, slot_minutes)
+
+    # Optional combined endpoint; any problem with it falls back to the two-call mode
+    combined_endpoint = env("COMBINED_ENDPOINT")
+    estaciones: list[dict] = []
+    lecturas: dict = {}
+    if combined_endpoint and not combined_endpoint.lower().startswith("https://"):
+        # It receives the REDMET credentials: never send them in clear text
+        print("WARN: COMBINED_ENDPOINT must be https://; ignoring it.", file=sys.stderr)
+    elif combined_endpoint:
+        try:
+            estaciones, lecturas = get_combined(combined_endpoint, lat, lon, redmet_user, redmet_pass, records_ttl)
+        except (requests.RequestException, ValueError) as e:
+            print(f"WARN: COMBINED_ENDPOINT failed ({e}); using REDMET directly.", file=sys.stderr)
 
-    estaciones = get_nearest_stations(base_ws, lat, lon, redmet_user, redmet_pass)
     if not estaciones:
-        print("INFO: No stations found.")
-        return 0
+        estaciones = get_nearest_stations(base_ws, lat, lon, redmet_user, redmet_pass)
+    if not estaciones:
+        return exit_without_alert("No stations found.")
 
     chosen = None
-
-    for sta in estaciones[:3]:
-        estacionid = sta.get("estacionid")
-        if not estacionid:
-            continue
-
-        records = get_station_records(base_ws, str(estacionid), fechaini, fechafin, redmet_user, redmet_pass)
-        rec, hi_val, t_val, dt_api, slot_used = pick_heatindex_record(records, slots, slot_minutes)
-        if rec is None:
-            continue
-
+    candidates = [sta for sta in estaciones[:3] if sta.get("estacionid")]
+
+    # getLecturas usually carries each station's latest reading. If the
+    # top-priority station's is fresh enough, skip the lecturas fetch.
+    hit: tuple | None = None
+    if candidates:
+        inline = pick_heatindex_record([candidates[0]], slots, slot_minutes)
+        if inline[0] is not None:
+            hit = (candidates[0], *inline)
+
+    # Records already delivered by the combined endpoint
+    if hit is None and lecturas:
+        for sta in candidates:
+            pick = pick_heatindex_record(lecturas.get(str(sta["estacionid"])) or [], slots, slot_minutes)
+            if pick[0] is not None:
+                hit = (sta, *pick)
+                break
+
+    if hit is None:
+        hit = pick_from_stations(
+            base_ws, candidates, fechaini, fechafin, redmet_user, redmet_pass, records_ttl, slots, slot_minutes
+        )
+
+    if hit is not None:
+        sta, rec, hi_val, t_val, dt_api, slot_used = hit
         age_min = (now_local - dt_api).total_seconds() / 60.0
         chosen = (sta, hi_val, t_val, age_min, slot_used, rec.get("fecha"))
-        break
 
     if not chosen:
-        print("INFO: No valid heat index found.")
-        return 0
+        return exit_without_alert("No valid heat index found.")
 
     sta, hi_val, t_val, age_min, slot_used, fecha_api = chosen
 
     if age_min > suppress_if_older_than_min:
-        print("INFO: Data too old, skipping alert.")
-        return 0
+        return exit_without_alert("Data too old, skipping alert.")
 
     if hi_val <= heat_index_threshold:
         print("INFO: No alert condition met.")
@@ -209,6 +521,7 @@ def main():
     )
 
     send_telegram_html(telegram_token, chat_ids, msg)
+    write_json_atomic(state_path, {"last_alerted_slot": base_slot.isoformat(), "last_hi": hi_val})
     print("INFO: Alert sent.")
     return 0
 